@@ -5,12 +5,31 @@
 import os
 import re
 import json
+import hashlib
+import heapq
+import html
 import sys
+import tempfile
 import time
-from datetime import datetime, date, timedelta
-
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta, timezone
+from functools import lru_cache
+from operator import attrgetter
+from typing import NamedTuple
+from zoneinfo import ZoneInfo
+
+import lxml.html
 import requests
-from bs4 import BeautifulSoup  # tylko dla legacy fallback, domyślnie wyłączony
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # szybki (de)serializer JSON; bez niego zostaje stdlib json
+except ImportError:
+    orjson = None
 
 # ─────────────────────────────────────────────────────────────────────────────
 # KONFIGURACJA (env / sekrety)
@@ -19,6 +38,7 @@ THRESHOLD = int(os.getenv("THRESHOLD", "7"))              # próg serii (>=)
 STATE_PATH = os.getenv("STATE_PATH", "state.json")
 ALERT_MODE = os.getenv("ALERT_MODE", "EACH").upper()      # EACH | THRESHOLD_ONLY
 RUN_INTERVAL_MIN = int(os.getenv("RUN_INTERVAL_MIN", "100"))  # minimalny odstęp (minuty) między PEŁNYMI przebiegami
+RETRY_INTERVAL_MIN = int(os.getenv("RETRY_INTERVAL_MIN", "30"))  # minimalny odstęp (minuty) między startami, także nieudanymi
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
@@ -27,8 +47,17 @@ DRY_RUN = os.getenv("DRY_RUN", "0") == "1"
 
 # Tryby bezpieczeństwa/diagnostyczne:
 USE_SCRAPE_FALLBACK = os.getenv("USE_SCRAPE_FALLBACK", "0") == "1"  # domyślnie WYŁ.
+USE_READER_FALLBACK = os.getenv("USE_READER_FALLBACK", "1") == "1"  # mirrory r.jina.ai w fallbacku (domyślnie WŁ.)
 FORCE_REBUILD = os.getenv("FORCE_REBUILD", "0") == "1"               # jednorazowo „udawaj puste state”
 MAX_REASONABLE_STREAK = int(os.getenv("MAX_REASONABLE_STREAK", "25"))  # hard‑guard na absurdalne wartości
+DEBUG_TAIL = os.getenv("DEBUG_TAIL", "0") == "1"                     # wydruk ogona FT także bez nowych meczów
+
+# ID Ekstraklasy w API-FOOTBALL jest stałe. Jawne EKSTRAKLASA_LEAGUE_ID wygrywa ze state.json
+# (0 = odpytaj /leagues); bez niego ID zbuforowane w state.json, a na końcu DEFAULT_LEAGUE_ID
+DEFAULT_LEAGUE_ID = 106
+_LEAGUE_ID_ENV = os.getenv("EKSTRAKLASA_LEAGUE_ID", "").strip()  # pusty sekret/zmienna = nie ustawione
+EKSTRAKLASA_LEAGUE_ID = int(_LEAGUE_ID_ENV) if _LEAGUE_ID_ENV else None
+REDISCOVER_LEAGUE = os.getenv("REDISCOVER_LEAGUE", "0") == "1"      # jednorazowo „odpytaj /leagues”
 
 # legacy (awaryjny last resort; normalnie nieużywane)
 LIGA90_ID = os.getenv("LIGA90_ID", "14072")  # http://www.90minut.pl/liga/1/liga14072.html
@@ -37,6 +66,19 @@ LIGA90_ID = os.getenv("LIGA90_ID", "14072")  # http://www.90minut.pl/liga/1/liga
 # KONST. API-FOOTBALL (v3)
 # ─────────────────────────────────────────────────────────────────────────────
 API_BASE = "https://v3.football.api-sports.io"  # docs: https://www.api-football.com/documentation-v3
+API_USER_AGENT = "ekstra-streak-telegram (+https://github.com/MichalZaorski/ekstra-streak-telegram)"
+
+# ─────────────────────────────────────────────────────────────────────────────
+# MECZ (lekka krotka zamiast dict z 7 kluczami)
+# ─────────────────────────────────────────────────────────────────────────────
+class Match(NamedTuple):
+    dt: str
+    date: str
+    time: str
+    home: str
+    away: str
+    home_goals: int
+    away_goals: int
 
 # ─────────────────────────────────────────────────────────────────────────────
 # POMOCNICZE
@@ -49,16 +91,59 @@ def season_slug(today: date | None = None) -> str:
     s = season_start_year(today)
     return f"{s}-{s+1}"
 
+def json_loads(raw: bytes | str):
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+def state_dumps(state: dict) -> bytes:
+    # ten sam układ co json.dump(..., ensure_ascii=False, indent=2) – diffy state.json bez szumu
+    if orjson:
+        return orjson.dumps(state, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(state, ensure_ascii=False, indent=2).encode("utf-8")
+
+_STATE_ON_DISK: bytes | None = None  # treść state.json z ostatniego odczytu/zapisu
+
 def load_state() -> dict:
+    global _STATE_ON_DISK
     try:
-        with open(STATE_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(STATE_PATH, "rb") as f:
+            raw = f.read()
+        state = json_loads(raw)
     except Exception:
         return {}
+    _STATE_ON_DISK = raw
+    return state
+
+def state_file_mode() -> int:
+    # NamedTemporaryFile tworzy plik 0600, a os.replace przenosi ten tryb na state.json –
+    # zostawiamy tryb istniejącego pliku, a nowy dostaje 0666 minus umask (jak przy open())
+    try:
+        return os.stat(STATE_PATH).st_mode & 0o7777
+    except FileNotFoundError:
+        umask = os.umask(0); os.umask(umask)
+        return 0o666 & ~umask
 
 def save_state(state: dict) -> None:
-    with open(STATE_PATH, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    """
+    Zapis tylko gdy treść się zmieniła; atomowo (unikalny plik tymczasowy
+    w tym samym katalogu + fsync + os.replace), więc przerwany run nie
+    zostawi uciętego state.json.
+    """
+    global _STATE_ON_DISK
+    payload = state_dumps(state)
+    if payload == _STATE_ON_DISK:
+        return
+    with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(STATE_PATH) or ".",
+                                     prefix=".state-", suffix=".tmp", delete=False) as f:
+        try:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())  # treść na dysku zanim rename ją opublikuje
+            os.chmod(f.name, state_file_mode())
+        except BaseException:
+            f.close(); os.unlink(f.name)
+            raise
+    os.replace(f.name, STATE_PATH)
+    _STATE_ON_DISK = payload
 
 def guard_min_interval(state: dict) -> bool:
     """
@@ -66,285 +151,581 @@ def guard_min_interval(state: dict) -> bool:
     """
     now = time.time()
     last_run_ts = state.get("last_full_run_ts")
-    if last_run_ts is None:
-        return False
-    if now - float(last_run_ts) < RUN_INTERVAL_MIN * 60:
+    if last_run_ts is not None and now - float(last_run_ts) < RUN_INTERVAL_MIN * 60:
         print(f"[SKIP] Minęło < {RUN_INTERVAL_MIN} min od ostatniego pełnego przebiegu. Kończę bez zapytań.")
         return True
+    # nieudany przebieg nie stempluje last_full_run_ts – bez tego kolejny start od razu znów pytałby API
+    last_start_ts = state.get("last_run_start_ts")
+    if last_start_ts is not None and now - float(last_start_ts) < RETRY_INTERVAL_MIN * 60:
+        print(f"[SKIP] Minęło < {RETRY_INTERVAL_MIN} min od ostatniej próby. Kończę bez zapytań.")
+        return True
     return False
 
 def stamp_run(state: dict) -> None:
     state["last_full_run_ts"] = time.time()
-    save_state(state)
 
 # ─────────────────────────────────────────────────────────────────────────────
-# API‑FOOTBALL (v3)
+# HTTP (wspólna sesja: pula połączeń + retry w urllib3)
 # ─────────────────────────────────────────────────────────────────────────────
-def api_session() -> requests.Session:
+BROWSER_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/128.0.0.0 Safari/537.36"
+    ),
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "pl-PL,pl;q=0.9,en-US;q=0.8,en;q=0.7",
+    "Connection": "keep-alive",
+}
+
+# (connect, read): zawieszony handshake odpada po 5 s, długi budżet tylko na treść
+# (r.jina.ai potrafi renderować stronę kilkanaście sekund)
+HTTP_TIMEOUT = (5, 25)
+
+HTTP_RETRY = Retry(
+    total=5,
+    backoff_factor=2,
+    status_forcelist=(403, 429, 500, 502, 503, 504),
+    allowed_methods=frozenset({"GET", "POST"}),
+    respect_retry_after_header=True,
+)
+
+# API odpowiada 403 przy złym kluczu/planie – tego nie ponawiamy
+API_RETRY = HTTP_RETRY.new(status_forcelist=(429, 500, 502, 503, 504))
+
+def build_session(headers: dict | None = None, retry: Retry = HTTP_RETRY) -> requests.Session:
     s = requests.Session()
-    s.headers.update({"x-apisports-key": API_FOOTBALL_KEY})
+    if headers:
+        s.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=retry)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
     return s
 
-def api_get_league_id_poland_ekstraklasa(session_api: requests.Session) -> int:
+SESSION = build_session(BROWSER_HEADERS)  # scraper (keep-alive przez cały run)
+
+# ─────────────────────────────────────────────────────────────────────────────
+# API‑FOOTBALL (v3)
+# ─────────────────────────────────────────────────────────────────────────────
+@lru_cache(maxsize=None)
+def api_session() -> requests.Session:
+    # ta sama pula połączeń i ponawianie co w SESSION: stronicowanie /fixtures idzie po jednym TLS;
+    # jedna instancja na proces, więc kolejne wywołania main() trzymają otwarte połączenia
+    # własny User-Agent zamiast python-requests; gzip (Accept-Encoding) requests wysyła domyślnie
+    return build_session({"x-apisports-key": API_FOOTBALL_KEY, "User-Agent": API_USER_AGENT}, retry=API_RETRY)
+
+def api_get_league_id_poland_ekstraklasa(session_api: requests.Session, state: dict) -> int:
     """
-    Buforujemy ID ligi w state.json, aby nie pytać co run.
+    Kolejność: REDISCOVER_LEAGUE=1 (odpytaj /leagues) → jawnie ustawione
+    EKSTRAKLASA_LEAGUE_ID (0 = odpytaj /leagues) → ID zbuforowane w
+    state.json → DEFAULT_LEAGUE_ID. Wynik /leagues buforujemy w state.json
+    dla kolejnych przebiegów.
     """
-    state = load_state()
-    if "apifootball_league_id" in state:
-        return int(state["apifootball_league_id"])
+    if not REDISCOVER_LEAGUE:
+        if EKSTRAKLASA_LEAGUE_ID is None:
+            return int(state.get("apifootball_league_id", DEFAULT_LEAGUE_ID))
+        if EKSTRAKLASA_LEAGUE_ID:
+            return EKSTRAKLASA_LEAGUE_ID
     url = f"{API_BASE}/leagues?country=Poland&name=Ekstraklasa"
-    r = session_api.get(url, timeout=30); r.raise_for_status()
-    data = r.json()
+    r = session_api.get(url, timeout=HTTP_TIMEOUT); r.raise_for_status()
+    data = json_loads(r.content)
     resp = data.get("response", [])
     if not resp:
         raise RuntimeError("API: nie znaleziono ligi 'Ekstraklasa' w kraju 'Poland'.")
     league_id = int(resp[0]["league"]["id"])
     state["apifootball_league_id"] = league_id
-    save_state(state)
     return league_id
 
+API_PAGE_WORKERS = 4  # ile stron /fixtures pobieramy naraz (free plan ma limit zapytań/min)
+
+def api_fixtures_page(session_api: requests.Session, base_url: str, page: int,
+                      etag_cache: dict | None = None) -> dict | None:
+    """
+    etag_cache ({url, etag}): warunkowy GET; None = 304, czyli odpowiedź
+    identyczna z już przetworzoną w poprzednim przebiegu. Po 200 wpis
+    dostaje ETag tej odpowiedzi.
+    """
+    url = f"{base_url}&page={page}"
+    headers = {"If-None-Match": etag_cache["etag"]} if etag_cache and etag_cache.get("url") == url else None
+    r = session_api.get(url, headers=headers, timeout=HTTP_TIMEOUT); r.raise_for_status()
+    if r.status_code == 304:
+        return None
+    if etag_cache is not None:
+        etag_cache.clear()
+        if r.headers.get("ETag"):
+            etag_cache.update(url=url, etag=r.headers["ETag"])
+    return json_loads(r.content)
+
+def fixture_to_match(item: dict) -> Match | None:
+    # None = mecz bez wyniku (brak goli w odpowiedzi)
+    hg = item["goals"]["home"]; ag = item["goals"]["away"]
+    if hg is None or ag is None:
+        return None
+    dt_iso = item["fixture"]["date"]
+    home = sys.intern(item["teams"]["home"]["name"])  # ~18 drużyn na sezon → te same obiekty str
+    away = sys.intern(item["teams"]["away"]["name"])
+    return Match(dt_iso, dt_iso[:10], dt_iso[11:16], home, away, int(hg), int(ag))
+
 def api_fetch_fixtures_incremental(session_api: requests.Session, league_id: int, season_year: int,
-                                   last_checked_dt: str | None) -> list[dict]:
+                                   last_checked_dt: str | None,
+                                   etag_cache: dict | None = None) -> tuple[list[Match], list[dict] | None, dict]:
     """
     Pobiera tylko nowe mecze:
       - gdy last_checked_dt brak lub FORCE_REBUILD=1 → pobiera cały sezon (FT) (tylko raz)
-      - gdy last_checked_dt jest → pobiera okno from=last_checked_dt..jutro (FT)
+      - gdy last_checked_dt jest → pobiera okno from=last_checked_dt..jutro (FT);
+        jednostronicowe okno idzie warunkowym GET-em (etag_cache), 304 = brak nowych meczów
+    Zwraca (mecze, wiersze ostatniej strony sezonu, nowy wpis ETag). Wiersze
+    tylko przy pobraniu całego sezonu – wtedy ogon FT nie wymaga osobnych
+    zapytań. etag_cache (state["api_etag"]) tylko czytamy: nowy wpis wołający
+    zapisuje razem z last_checked_dt, więc przerwany przebieg nie zostawi
+    w state ETagu okna, którego mecze nie zostały policzone.
     """
-    matches: list[dict] = []
-    page = 1
-    total_pages = 1
+    matches: list[Match] = []
 
     base_url = f"{API_BASE}/fixtures?league={league_id}&season={season_year}&status=FT"
-    if last_checked_dt and not FORCE_REBUILD:
+    windowed = bool(last_checked_dt and not FORCE_REBUILD)
+    if windowed:
         from_date = last_checked_dt[:10]
-        to_date = (datetime.utcnow() + timedelta(days=1)).strftime("%Y-%m-%d")
+        to_date = (datetime.now(timezone.utc) + timedelta(days=1)).strftime("%Y-%m-%d")
         base_url += f"&from={from_date}&to={to_date}"
 
-    while page <= total_pages:
-        url = f"{base_url}&page={page}"
-        r = session_api.get(url, timeout=30); r.raise_for_status()
-        data = r.json()
-        paging = data.get("paging", {})
-        total_pages = int(paging.get("total", 1)) or 1
+    # strona 1 podaje paging.total; pozostałe strony pobieramy równolegle (I/O-bound)
+    new_etag: dict = dict(etag_cache or {}) if windowed else {}
+    first = api_fixtures_page(session_api, base_url, 1, new_etag if windowed else None)
+    if first is None:
+        print("[INFO] API: 304 Not Modified – okno bez zmian od poprzedniego przebiegu.")
+        return [], None, new_etag
+    total_pages = int(first.get("paging", {}).get("total", 1)) or 1
+    if total_pages > 1:
+        new_etag.clear()  # ETag strony 1 nie mówi nic o kolejnych stronach
+    pages = [first]
+    if total_pages > 1:
+        with ThreadPoolExecutor(max_workers=min(API_PAGE_WORKERS, total_pages - 1)) as pool:
+            pages += pool.map(lambda p: api_fixtures_page(session_api, base_url, p), range(2, total_pages + 1))
+
+    needs_sort = False
+    for data in pages:
         for item in data.get("response", []):
-            dt_iso = item["fixture"]["date"]
             # dodatkowy filtr po dacie na wszelki wypadek
-            if last_checked_dt and not FORCE_REBUILD and dt_iso <= last_checked_dt:
-                continue
-            home = item["teams"]["home"]["name"]
-            away = item["teams"]["away"]["name"]
-            hg = item["goals"]["home"]; ag = item["goals"]["away"]
-            if hg is None or ag is None:
+            if windowed and item["fixture"]["date"] <= last_checked_dt:
                 continue
-            matches.append({
-                "dt": dt_iso,
-                "date": dt_iso[:10],
-                "time": dt_iso[11:16],
-                "home": home,
-                "away": away,
-                "home_goals": int(hg),
-                "away_goals": int(ag),
-            })
-        page += 1
-
-    matches.sort(key=lambda m: m["dt"])
-    return matches
-
-def api_fetch_recent_tail(session_api: requests.Session, league_id: int, season_year: int, tail: int = 10) -> list[dict]:
-    """
-    Druk kontrolny: pobierz OSTATNIĄ stronę FT i zwróć końcowe 'tail' meczów.
-    Dwa zapytania: page=1 (żeby poznać paging.total), potem page=total.
-    """
-    # 1) pobierz pierwszą stronę, odczytaj paging.total
-    url1 = f"{API_BASE}/fixtures?league={league_id}&season={season_year}&status=FT&page=1"
-    r1 = session_api.get(url1, timeout=30); r1.raise_for_status()
-    data1 = r1.json()
-    total_pages = int(data1.get("paging", {}).get("total", 1)) or 1
-
-    # 2) pobierz ostatnią stronę
-    url_last = f"{API_BASE}/fixtures?league={league_id}&season={season_year}&status=FT&page={total_pages}"
-    r2 = session_api.get(url_last, timeout=30); r2.raise_for_status()
-    data2 = r2.json()
-    rows = data2.get("response", [])
-    out: list[dict] = []
-
-    for item in rows[-tail:]:
-        dt_iso = item["fixture"]["date"]
-        home = item["teams"]["home"]["name"]
-        away = item["teams"]["away"]["name"]
-        hg = item["goals"]["home"]; ag = item["goals"]["away"]
-        if hg is None or ag is None:
-            continue
-        out.append({
-            "dt": dt_iso,
-            "date": dt_iso[:10],
-            "time": dt_iso[11:16],
-            "home": home,
-            "away": away,
-            "home_goals": int(hg),
-            "away_goals": int(ag),
-        })
-    return out
+            m = fixture_to_match(item)
+            if m:
+                if matches and m.dt < matches[-1].dt: needs_sort = True
+                matches.append(m)
+
+    # API zwraca mecze chronologicznie – sortujemy tylko, gdy trafi się wyjątek
+    if needs_sort:
+        matches.sort(key=attrgetter("dt"))
+    return matches, (None if windowed else pages[-1].get("response", [])), new_etag
+
+def api_fetch_recent_tail(session_api: requests.Session, league_id: int, season_year: int, tail: int = 10,
+                          last_page_rows: list[dict] | None = None) -> list[Match]:
+    """
+    Druk kontrolny: końcowe 'tail' meczów z OSTATNIEJ strony FT.
+    Gdy last_page_rows przyszły z api_fetch_fixtures_incremental – zero zapytań;
+    inaczej page=1 (paging.total) i, jeśli stron jest więcej, page=total.
+    """
+    if last_page_rows is None:
+        base_url = f"{API_BASE}/fixtures?league={league_id}&season={season_year}&status=FT"
+        data = api_fixtures_page(session_api, base_url, 1)
+        total_pages = int(data.get("paging", {}).get("total", 1)) or 1
+        if total_pages > 1:
+            data = api_fixtures_page(session_api, base_url, total_pages)
+        last_page_rows = data.get("response", [])
+    return [m for m in map(fixture_to_match, last_page_rows[-tail:]) if m]
 
 # ─────────────────────────────────────────────────────────────────────────────
 # LEGACY FALLBACK (wyłączony domyślnie; zostaje awaryjnie)
 # ─────────────────────────────────────────────────────────────────────────────
-BROWSER_HEADERS = {
-    "User-Agent": (
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-        "AppleWebKit/537.36 (KHTML, like Gecko) "
-        "Chrome/128.0.0.0 Safari/537.36"
-    ),
-    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-    "Accept-Language": "pl-PL,pl;q=0.9,en-US;q=0.8,en;q=0.7",
-    "Connection": "keep-alive",
+def http_get_with_retry(session: requests.Session, url: str, cached: dict | None = None) -> requests.Response:
+    # ponawianie (403/429/5xx, backoff, Retry-After) robi adapter urllib3 sesji
+    headers = {}
+    if cached:
+        # warunkowy GET: przy braku zmian serwer odda 304 bez treści
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    r = session.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+    r.raise_for_status()
+    return r
+
+# źródła fallbacku w kolejności priorytetu: (szablon URL, tag)
+_SCRAPE_SOURCES = (
+    ("http://www.90minut.pl/liga/1/liga{liga90}.html", "90minut"),
+    ("https://www.worldfootball.net/all_matches/pol-ekstraklasa-{season}/", "worldfootball-all"),
+    ("https://www.worldfootball.net/schedule/pol-ekstraklasa-{season}/", "worldfootball-schedule"),
+    ("https://www.weltfussball.de/alle_spiele/pol-ekstraklasa-{season}/", "weltfussball-alle"),
+    ("https://www.weltfussball.de/spielplan/pol-ekstraklasa-{season}/", "weltfussball-spielplan"),
+)
+
+@lru_cache(maxsize=4)
+def candidate_urls_for_season(season: str) -> tuple[tuple[str, bool, str], ...]:
+    """
+    Kolejność = priorytet: najpierw źródła bezpośrednie, potem ich warianty
+    przez r.jina.ai (reader_mode=True, tag z sufiksem "-reader");
+    te ostatnie tylko przy USE_READER_FALLBACK=1.
+    """
+    direct = [(tpl.format(season=season, liga90=LIGA90_ID), tag) for tpl, tag in _SCRAPE_SOURCES]
+    readers = [("https://r.jina.ai/http://" + u.split("://", 1)[1], tag) for u, tag in direct] if USE_READER_FALLBACK else []
+    return (*((u, False, tag) for u, tag in direct),
+            *((u, True, f"{tag}-reader") for u, tag in readers))
+
+# wzorce kompilowane raz na proces (nie przy każdym wywołaniu/wierszu)
+_RX_SCORE = re.compile(r"\s*(\d+)\s*[:–-]\s*(\d+)")  # .match: wynik na początku komórki, np. "2:1 (1:0)"
+# "Gospodarz - Gość 2:1" szukamy w całej linii PRZED "Gospodarz 2:1 Gość" – jedna alternatywa
+# brałaby dopasowanie najbardziej z lewej, np. godzinę "18:00" zamiast wyniku na końcu linii
+_RX_HYPHEN = re.compile(r"(.{3,60}?)\s[-–]\s(.{3,60}?)\s(\d{1,2})\s*[:–-]\s*(\d{1,2})")
+_RX_INLINE = re.compile(r"(.{3,60}?)\s(\d{1,2})\s*[:–-]\s*(\d{1,2})\s(.{3,60})")
+# jeden finditer po całym tekście wybiera tylko linie z czymś w rodzaju wyniku ("2:1", "0 - 0");
+# na reszcie (nagłówki, menu, długie akapity) leniwe .{3,60}? _RX_HYPHEN/_RX_INLINE nie są w ogóle uruchamiane
+_RX_TEXT_SCORE_LINE = re.compile(r"^[^\n]*\d[^\S\n]*[:–-][^\S\n]*\d[^\n]*", re.MULTILINE)
+
+# tabele meczów (worldfootball/weltfussball) i ich wiersze wybierane XPath w libxml2
+_XP_MATCH_TABLES = etree.XPath("//table[contains(concat(' ', normalize-space(@class), ' '), ' standard_tabelle ')]")
+_XP_MATCH_ROWS = etree.XPath(".//tr[count(td) >= 5]")
+
+def parse_score(score: str) -> tuple[int, int] | None:
+    # szybka ścieżka bez regex dla typowego "2:1" / "2:1 (1:0)"; inne separatory → _RX_SCORE
+    h, sep, rest = score.partition(":")
+    a = rest.split(None, 1)[0] if sep and rest.strip() else ""
+    h = h.strip()
+    if h.isdecimal() and a.isdecimal():
+        return int(h), int(a)
+    m = _RX_SCORE.match(score)
+    return (int(m[1]), int(m[2])) if m else None
+
+# dt meczów bez rozpoznanej daty (parser tekstu, nieczytelna komórka daty)
+UNDATED_DT = datetime(1900, 1, 1).isoformat()
+
+# godziny w tabelach (worldfootball/weltfussball/90minut) to czas polski
+SCRAPE_TZ = ZoneInfo("Europe/Warsaw")
+
+def to_utc_iso(dt: datetime) -> str:
+    # jak fixture.date z API-FOOTBALL ("2024-08-10T16:00:00+00:00") – last_checked_dt
+    # porównujemy jako string, więc oba źródła muszą dawać ten sam format i strefę
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=SCRAPE_TZ)
+    return dt.astimezone(timezone.utc).isoformat()
+
+def cell_text(td) -> str:
+    # jak get_text(" ", strip=True): tekst komórki z ujednoliconymi białymi znakami;
+    # komórka bez znaczników (data, godzina, wynik) – wprost z .text, bez XPath string()
+    return " ".join((td.text_content() if len(td) else (td.text or "")).split())
+
+# formaty dat w tabelach worldfootball (dd/mm/yyyy) i weltfussball (dd.mm.yyyy);
+# klucz: (separator, długość roku) – format wybieramy bez prób i ValueError
+_DATE_FORMATS = {
+    ("/", 4): "%d/%m/%Y", (".", 4): "%d.%m.%Y",
+    ("/", 2): "%d/%m/%y", (".", 2): "%d.%m.%y",
 }
 
-def http_get_with_retry(session: requests.Session, url: str, max_tries: int = 4, backoff: float = 2.0) -> requests.Response:
-    last_exc: Exception | None = None
-    for i in range(max_tries):
+def parse_datetime(d_str: str, t_str: str) -> datetime | None:
+    """
+    Separator i długość roku wyznaczają format, więc zwykle wystarcza
+    jedno strptime na datę z godziną.
+    """
+    sep = "/" if "/" in d_str else "."
+    parts = d_str.split(sep)
+    fmt = _DATE_FORMATS.get((sep, len(parts[-1]))) if len(parts) == 3 else None
+    if fmt is None:
+        return None
+    # szybka ścieżka bez strptime dla typowego "dd/mm/yyyy" + "hh:mm"
+    day, mon, yr = parts
+    hh, colon, mm = t_str.partition(":") if t_str else ("0", ":", "00")
+    digits = day + mon + yr + hh + mm
+    if (colon and len(yr) == 4 and 1 <= len(day) <= 2 and 1 <= len(mon) <= 2 and 1 <= len(hh) <= 2
+            and len(mm) == 2 and digits.isascii() and digits.isdigit()):
         try:
-            r = session.get(url, timeout=30)
-            if r.status_code == 200:
-                return r
-            if r.status_code in (403, 429):
-                time.sleep(backoff * (i + 1))
-                continue
-            r.raise_for_status()
-        except requests.RequestException as e:
-            last_exc = e
-            time.sleep(backoff * (i + 1))
-    if last_exc:
-        raise last_exc
-    raise RuntimeError(f"Nieudane pobranie: {url}")
-
-def candidate_urls_for_season(season: str) -> list[tuple[str, bool, str]]:
-    urls: list[tuple[str, bool, str]] = []
-    u90 = f"http://www.90minut.pl/liga/1/liga{LIGA90_ID}.html"
-    urls.append((u90, False, "90minut"))
-    urls.append((f"https://r.jina.ai/http://www.90minut.pl/liga/1/liga{LIGA90_ID}.html", True, "90minut-reader"))
-    urls.append((f"https://www.worldfootball.net/all_matches/pol-ekstraklasa-{season}/", False, "worldfootball-all"))
-    urls.append((f"https://www.worldfootball.net/schedule/pol-ekstraklasa-{season}/", False, "worldfootball-schedule"))
-    urls.append((f"https://www.weltfussball.de/alle_spiele/pol-ekstraklasa-{season}/", False, "weltfussball-alle"))
-    urls.append((f"https://www.weltfussball.de/spielplan/pol-ekstraklasa-{season}/", False, "weltfussball-spielplan"))
-    base = "https://r.jina.ai/http://"
-    for u, _, tag in list(urls):
-        if "r.jina.ai" in u: continue
-        urls.append((base + u.replace("https://","").replace("http://",""), True, f"{tag}-reader"))
-    return urls
-
-def parse_matches_from_html_table(soup: BeautifulSoup) -> list[dict]:
-    matches: list[dict] = []
-    for table in soup.select("table.standard_tabelle"):
-        for tr in table.select("tr"):
-            tds = tr.find_all("td")
-            if len(tds) < 5: continue
-            d_str = tds[0].get_text(" ", strip=True)
-            t_str = tds[1].get_text(" ", strip=True)
-            home  = tds[2].get_text(" ", strip=True)
-            score = tds[3].get_text(" ", strip=True)
-            away  = tds[4].get_text(" ", strip=True)
-            m = re.search(r"(\d+)\s*[:–-]\s*(\d+)", score)
-            if not m: continue
-            hg, ag = int(m.group(1)), int(m.group(2))
-            dt = datetime(1900,1,1)
-            matches.append({
-                "dt": dt.isoformat(),
-                "date": d_str, "time": t_str,
-                "home": home, "away": away,
-                "home_goals": hg, "away_goals": ag,
-            })
-    matches.sort(key=lambda m: m["dt"])
-    return matches
-
-def parse_matches_from_text(content: str) -> list[dict]:
-    lines = [ln.strip() for ln in content.splitlines() if ln.strip()]
-    matches: list[dict] = []
-    rx_hyphen = re.compile(r"(.{3,60}?)\s[-–]\s(.{3,60}?)\s(\d{1,2})\s*[:–-]\s*(\d{1,2})")
-    rx_inline = re.compile(r"(.{3,60}?)\s(\d{1,2})\s*[:–-]\s*(\d{1,2})\s(.{3,60})")
-    for ln in lines:
-        m = rx_hyphen.search(ln) or rx_inline.search(ln)
-        if not m: continue
-        if m.re is rx_hyphen:
+            return datetime(int(yr), int(mon), int(day), int(hh), int(mm))
+        except ValueError:
+            pass  # np. 31/02 albo 24:00 – niech rozstrzygnie strptime
+    if t_str:
+        try:
+            return datetime.strptime(f"{d_str} {t_str}", f"{fmt} %H:%M")
+        except ValueError:
+            pass  # brak/nieczytelna godzina → sama data
+    try:
+        return datetime.strptime(d_str, fmt)
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=2048)
+def match_dt_iso(d_str: str, t_str: str) -> str:
+    # mecze kolejki dzielą datę i godzinę: parsowanie + przeliczenie na UTC raz na parę, nie na wiersz
+    dt = parse_datetime(d_str, t_str)
+    return to_utc_iso(dt) if dt else UNDATED_DT
+
+def html_document(content: bytes | str, encoding: str | None = None):
+    # bajty dekoduje libxml2 (charset z nagłówka albo z <meta>), bez kopii przez r.text
+    parser = lxml.html.HTMLParser(encoding=encoding) if encoding else None
+    return lxml.html.fromstring(content, parser=parser)
+
+def parse_matches_from_html_table(content: bytes | str, encoding: str | None = None) -> list[Match]:
+    """
+    Każda tabela jest zwykle już chronologiczna, więc zamiast sortować całość
+    scalamy listy z poszczególnych tabel (heapq.merge, O(N)). Tabelę sortujemy
+    tylko wtedy, gdy przy parsowaniu trafi się wiersz wcześniejszy od poprzedniego.
+    """
+    per_table: list[list[Match]] = []
+    prev_date = ""
+    for table in _XP_MATCH_TABLES(html_document(content, encoding)):
+        rows: list[Match] = []
+        prev_dt = ""
+        needs_sort = False
+        for tr in _XP_MATCH_ROWS(table):
+            tds = tr.findall("td")
+            # datę czytamy zawsze (przechodzi na kolejne wiersze), resztę dopiero przy poprawnym wyniku
+            d_str = prev_date = cell_text(tds[0]) or prev_date  # data tylko przy pierwszym meczu danego dnia
+            goals = parse_score(cell_text(tds[3]))
+            if not goals: continue
+            hg, ag = goals
+            t_str, home, away = cell_text(tds[1]), cell_text(tds[2]), cell_text(tds[4])
+            dt_iso = match_dt_iso(d_str, t_str)
+            if dt_iso < prev_dt: needs_sort = True
+            prev_dt = dt_iso
+            rows.append(Match(dt_iso, d_str, t_str, home, away, hg, ag))
+        if needs_sort:
+            rows.sort(key=attrgetter("dt"))  # heapq.merge wymaga posortowanych wejść
+        per_table.append(rows)
+    return list(heapq.merge(*per_table, key=attrgetter("dt")))
+
+def parse_matches_from_text(content: str) -> list[Match]:
+    matches: list[Match] = []
+    seen: set[tuple[str, str, int, int]] = set()  # reader-mode potrafi powtórzyć ten sam wynik
+    for line in _RX_TEXT_SCORE_LINE.finditer(content):
+        ln = line[0].strip()
+        m = _RX_HYPHEN.search(ln)
+        if m:
             home, away, hg, ag = m.group(1).strip(), m.group(2).strip(), int(m.group(3)), int(m.group(4))
         else:
+            m = _RX_INLINE.search(ln)
+            if not m: continue
             home, hg, ag, away = m.group(1).strip(), int(m.group(2)), int(m.group(3)), m.group(4).strip()
-        matches.append({
-            "dt": datetime(1900,1,1).isoformat(),
-            "date": "", "time": "",
-            "home": home, "away": away,
-            "home_goals": hg, "away_goals": ag,
-        })
+        key = (home, away, hg, ag)
+        if key in seen: continue
+        seen.add(key)
+        matches.append(Match(UNDATED_DT, "", "", home, away, hg, ag))
     return matches
 
-def fetch_all_matches_via_scrape_incremental(last_checked_dt: str | None) -> tuple[list[dict], str]:
-    season = season_slug()
-    urls = candidate_urls_for_season(season)
-    s = requests.Session(); s.headers.update(BROWSER_HEADERS)
-    last_error: Exception | None = None
-    for url, reader_mode, tag in urls:
-        try:
-            print(f"[INFO] (fallback) Próba pobrania ({tag}): {url}")
-            r = http_get_with_retry(s, url); content = r.text
-            if reader_mode:
-                matches = parse_matches_from_text(content)
-            else:
-                soup = BeautifulSoup(content, "html.parser")
-                matches = parse_matches_from_html_table(soup) if ("worldfootball" in url or "weltfussball" in url) else parse_matches_from_text(soup.get_text("\n", strip=True))
-            if not matches:
-                print(f"[WARN] (fallback) Brak wyników na: {url} – próbuję kolejny.")
-                continue
-            return matches, url
-        except Exception as e:
-            last_error = e
-            print(f"[WARN] (fallback) Błąd przy {url}: {e} – próbuję kolejny.")
-            continue
-    if last_error: raise last_error
+SCRAPE_WORKERS = 6  # ile kandydackich URL-i pobieramy równolegle
+
+# bloki <script>/<style> i komentarze znikają bez śladu (tekst wokół się skleja, jak w drzewie DOM);
+# pozostałe znaczniki → nowa linia; "<" bez litery/!/? to zwykły tekst
+_RX_HTML_SKIP = re.compile(r"<(script|style)\b.*?</\1\s*>|<!--.*?-->", re.S | re.I)
+_RX_HTML_TAG = re.compile(r"<[!/?a-zA-Z][^>]*>")
+_RX_META_CHARSET = re.compile(rb"""<meta[^>]+charset=["']?([\w.:-]+)""", re.I)
+
+def decode_html(content: bytes | str, encoding: str | None = None) -> str:
+    # charset z nagłówka, potem z <meta> na początku strony (90minut: iso-8859-2), na końcu utf-8
+    if isinstance(content, str):
+        return content
+    if not encoding:
+        m = _RX_META_CHARSET.search(content, 0, 4096)
+        encoding = m[1].decode("ascii") if m else "utf-8"
+    try:
+        return content.decode(encoding, errors="replace")
+    except LookupError:
+        return content.decode("utf-8", errors="replace")
+
+def html_to_text(content: bytes | str, encoding: str | None = None) -> str:
+    """
+    Tekst strony dla parse_matches_from_text bez budowania drzewa DOM:
+    <script>/<style>/komentarze wycinamy, znaczniki zamieniamy na nowe linie,
+    encje dekodujemy dopiero po wycięciu znaczników.
+    """
+    text = _RX_HTML_SKIP.sub("", decode_html(content, encoding))
+    return html.unescape(_RX_HTML_TAG.sub("\n", text))
+
+def parse_scraped(r: requests.Response, url: str, reader_mode: bool) -> list[Match]:
+    if reader_mode:
+        return parse_matches_from_text(r.text)  # reader zwraca zwykły tekst
+    # tylko jawny charset z Content-Type; bez niego liczy się <meta charset> strony
+    encoding = r.encoding if "charset=" in r.headers.get("Content-Type", "").lower() else None
+    if "worldfootball" in url or "weltfussball" in url:
+        return parse_matches_from_html_table(r.content, encoding)
+    return parse_matches_from_text(html_to_text(r.content, encoding))
+
+# wersja formatu wpisów http_cache – podbić przy każdej zmianie parsera albo pól Match
+# (2: dt w UTC); wpis innej wersji traktujemy jak brak cache, więc źródło parsujemy od nowa
+SCRAPE_CACHE_VERSION = 2
+
+def scrape_one(session: requests.Session, url: str, reader_mode: bool, tag: str,
+               cached: dict | None = None) -> tuple[list[Match], dict]:
+    """
+    Zwraca (mecze, wpis cache). Przy 304 albo identycznej treści (ten sam hash)
+    oddaje mecze sparsowane poprzednio, bez ponownego parsowania.
+    """
+    print(f"[INFO] (fallback) Próba pobrania ({tag}): {url}")
+    if cached and cached.get("version") != SCRAPE_CACHE_VERSION:
+        cached = None
+    r = http_get_with_retry(session, url, cached)
+    if r.status_code == 304 and cached:
+        print(f"[INFO] (fallback) 304 Not Modified – używam zapisanych meczów: {url}")
+        return [Match(**m) for m in cached["matches"]], cached
+    body_hash = hashlib.blake2b(r.content, digest_size=16).hexdigest()
+    if cached and cached.get("hash") == body_hash:
+        print(f"[INFO] (fallback) Treść bez zmian – używam zapisanych meczów: {url}")
+        matches = [Match(**m) for m in cached["matches"]]
+    else:
+        matches = parse_scraped(r, url, reader_mode)
+    return matches, {
+        "version": SCRAPE_CACHE_VERSION,
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "hash": body_hash,
+        "matches": [m._asdict() for m in matches],
+    }
+
+def take_scraped(get, url: str, tag: str, http_cache: dict,
+                 errors: dict[str, Exception]) -> tuple[list[Match], str] | None:
+    # get() → (mecze, wpis cache); None = źródło padło albo nie ma meczów
+    try:
+        matches, entry = get()
+    except Exception as e:
+        errors[tag] = e
+        print(f"[WARN] (fallback) Błąd przy {url}: {e} – próbuję kolejny.")
+        return None
+    if not matches:
+        print(f"[WARN] (fallback) Brak wyników na: {url} – próbuję kolejny.")
+        return None
+    http_cache.clear()
+    http_cache[url] = entry
+    return matches, url
+
+def scrape_candidates(candidates: list[tuple[str, bool, str]], http_cache: dict,
+                      errors: dict[str, Exception]) -> tuple[list[Match], str] | None:
+    """
+    Pierwszego kandydata (zwykle last_good_url) pobieramy sam – gdy wygra,
+    cały fallback to jedno zapytanie. Dopiero gdy padnie albo nie ma meczów,
+    resztę pobieramy równolegle (I/O-bound) i odbieramy w kolejności priorytetu.
+    Błędy pobrania/parsowania trafiają do errors (tag → wyjątek).
+    """
+    if not candidates:
+        return None
+    (url, reader_mode, tag), rest = candidates[0], candidates[1:]
+    hit = take_scraped(lambda: scrape_one(SESSION, url, reader_mode, tag, http_cache.get(url)),
+                       url, tag, http_cache, errors)
+    if hit or not rest:
+        return hit
+    # uruchomionego zapytania nie da się przerwać (a interpreter i tak czeka na wątki przy wyjściu),
+    # więc po wygranej with czeka też na przegrane źródła – włącznie z ich retry/backoff
+    with ThreadPoolExecutor(max_workers=min(SCRAPE_WORKERS, len(rest))) as pool:
+        futures = [(pool.submit(scrape_one, SESSION, u, rm, t, http_cache.get(u)), u, t) for u, rm, t in rest]
+        for fut, u, t in futures:
+            hit = take_scraped(fut.result, u, t, http_cache, errors)
+            if hit:
+                return hit
+    return None
+
+def fetch_all_matches_via_scrape_incremental(last_checked_dt: str | None, http_cache: dict,
+                                             preferred_url: str | None = None) -> tuple[list[Match], str]:
+    """
+    http_cache (state["http_cache"]): url → {etag, last_modified, hash, matches};
+    trzymamy tylko wpis źródła, które ostatnio wygrało.
+    preferred_url (state["last_good_url"]) idzie na początek pierwszej rundy,
+    także gdy to wariant reader – nie płacimy znów za zablokowane źródło.
+    Wariant reader (r.jina.ai) danego źródła próbujemy tylko, gdy wersja
+    bezpośrednia padła (sieć/HTTP) – nie gdy zwróciła stronę bez meczów.
+    """
+    candidates = candidate_urls_for_season(season_slug())
+    preferred = [c for c in candidates if c[0] == preferred_url]
+    rest = [c for c in candidates if c[0] != preferred_url]
+    errors: dict[str, Exception] = {}
+    hit = scrape_candidates(preferred + [c for c in rest if not c[1]], http_cache, errors)
+    if hit is None:
+        readers = [c for c in rest if c[1] and c[2].removesuffix("-reader") in errors]
+        hit = scrape_candidates(readers, http_cache, errors)
+    if hit is not None:
+        return hit
+    if errors: raise list(errors.values())[-1]
     raise RuntimeError("Scrape fallback nie zadziałał.")
 
 # ─────────────────────────────────────────────────────────────────────────────
 # SERIA BEZ REMISÓW
 # ─────────────────────────────────────────────────────────────────────────────
-def apply_new_matches_to_streak(streak: int, new_matches: list[dict]) -> tuple[int, dict | None]:
-    last = None
-    for m in new_matches:
-        if m["home_goals"] == m["away_goals"]:
-            streak = 0
-            last = None
-        else:
-            streak += 1
-            last = m
-    return streak, last
+def apply_new_matches_to_streak(streak: int, new_matches: list[Match]) -> tuple[int, Match | None]:
+    """
+    Liczymy od końca: znaczenie ma tylko ogon po ostatnim remisie, więc
+    kończymy na pierwszym napotkanym remisie. Bez remisu w new_matches
+    seria z poprzednich przebiegów (streak) przechodzi dalej.
+    """
+    tail = 0
+    for m in reversed(new_matches):
+        if m.home_goals == m.away_goals:
+            return tail, (new_matches[-1] if tail else None)
+        tail += 1
+    return streak + tail, (new_matches[-1] if tail else None)
 
 # ─────────────────────────────────────────────────────────────────────────────
 # TELEGRAM
 # ─────────────────────────────────────────────────────────────────────────────
+TELEGRAM_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage" if TELEGRAM_TOKEN else None
+
+# sendMessage nie jest idempotentne: 5xx/timeout po wysłaniu mógł już dostarczyć wiadomość,
+# więc ponawiamy tylko błąd połączenia i 429 (odrzucone, z Retry-After); 403 = bot zablokowany
+TELEGRAM_RETRY = HTTP_RETRY.new(status_forcelist=(429,), allowed_methods=frozenset({"POST"}), read=False, other=0)
+TELEGRAM_SESSION = build_session(retry=TELEGRAM_RETRY)
+
 def send_telegram(text: str) -> None:
     if DRY_RUN:
         print("[DRY_RUN] Telegram message would be:\n", text); return
     if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
         print("Brak TELEGRAM_TOKEN/TELEGRAM_CHAT_ID w env.", file=sys.stderr); return
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-    resp = requests.post(url, data={
+    resp = TELEGRAM_SESSION.post(TELEGRAM_URL, data={
         "chat_id": TELEGRAM_CHAT_ID,
         "text": text,
         "parse_mode": "HTML",
         "disable_web_page_preview": True
-    }, timeout=30)
+    }, timeout=HTTP_TIMEOUT)
     resp.raise_for_status()
 
+def telegram_nothing_sent(e: Exception) -> bool:
+    # True tylko gdy wiadomość na pewno nie dotarła: brak połączenia (NewConnectionError,
+    # DNS, connect timeout – po retry w urllib3) albo 429 (Telegram ją odrzucił)
+    if isinstance(e, requests.exceptions.RetryError):  # 429 aż do wyczerpania TELEGRAM_RETRY
+        return True
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and e.response.status_code == 429
+    reason = getattr(e.args[0], "reason", None) if isinstance(e, requests.ConnectionError) and e.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+def try_send_telegram(text: str) -> bool:
+    """
+    False = wiadomość na pewno nie wyszła (telegram_nothing_sent). Wołający
+    nie przesuwa wtedy last_checked_dt, last_streak_len ani last_full_run_ts,
+    więc kolejny przebieg (po RETRY_INTERVAL_MIN) spróbuje wysłać alert ponownie.
+    Błąd niejednoznaczny (5xx, timeout odczytu – wiadomość mogła dotrzeć) albo
+    trwały (403 zablokowany bot, 400 błąd HTML) tylko logujemy i stan idzie dalej:
+    ponowienie zdublowałoby alert albo pytało API co przebieg bez skutku.
+    """
+    try:
+        send_telegram(text)
+    except Exception as e:
+        if telegram_nothing_sent(e):
+            print(f"[WARN] Telegram: wiadomość nie wyszła ({e}) – stan bez zmian, ponowię w kolejnym przebiegu.")
+            return False
+        print(f"[ERROR] Telegram: wysyłka nieudana albo niepewna ({e}) – nie ponawiam.", file=sys.stderr)
+    return True
+
 # ─────────────────────────────────────────────────────────────────────────────
 # MAIN
 # ─────────────────────────────────────────────────────────────────────────────
-def main() -> None:
-    state = load_state()
-
+def run(state: dict) -> None:
+    """
+    Cały przebieg na jednym słowniku state; zapis robi main() raz, na końcu.
+    """
     # 0) Ogranicznik interwału (co >= RUN_INTERVAL_MIN minut)
     if guard_min_interval(state):
         return
+    state["last_run_start_ts"] = time.time()
 
     # 1) Inicjalny stan
     last_checked_dt = None if FORCE_REBUILD else state.get("last_checked_dt")
+    if last_checked_dt and datetime.fromisoformat(last_checked_dt).tzinfo is None:
+        # starszy fallback zapisywał naiwny czas polski – sprowadzamy do UTC jak daty z API
+        last_checked_dt = to_utc_iso(datetime.fromisoformat(last_checked_dt))
     prev_streak = 0 if FORCE_REBUILD else int(state.get("last_streak_len", 0))
     last_notified_dt = state.get("last_notified_dt")
 
@@ -352,72 +733,70 @@ def main() -> None:
     if API_FOOTBALL_KEY:
         try:
             s_api = api_session()
-            league_id = api_get_league_id_poland_ekstraklasa(s_api)
+            league_id = api_get_league_id_poland_ekstraklasa(s_api, state)
             season_year = season_start_year()
             print(f"[INFO] API: Ekstraklasa league_id={league_id}, season={season_year}, since={last_checked_dt or 'BEGIN'}"
                   + (" [FORCE_REBUILD]" if FORCE_REBUILD else ""))
 
-            new_matches = api_fetch_fixtures_incremental(s_api, league_id, season_year, last_checked_dt)
-
-            # Kontrolny wydruk: ostatnie 10 meczów FT (niezależnie od 'new_matches')
-            try:
-                tail = api_fetch_recent_tail(s_api, league_id, season_year, tail=10)
-                print("[KONTROLA] Ostatnie 10 meczów (FT) w sezonie:")
-                for m in tail:
-                    tag = "  REMIS" if m["home_goals"] == m["away_goals"] else ""
-                    print(f" - {m['date']} {m['time']}  {m['home']} {m['home_goals']}–{m['away_goals']} {m['away']}{tag}")
-            except Exception as e:
-                print(f"[KONTROLA] Nie udało się pobrać ogona FT: {e}")
+            new_matches, last_page_rows, api_etag = api_fetch_fixtures_incremental(
+                s_api, league_id, season_year, last_checked_dt, state.get("api_etag"))
+
+            # Kontrolny wydruk: ostatnie 10 meczów FT – tylko gdy są nowe mecze (albo DEBUG_TAIL=1),
+            # bez zmian to 2 zbędne zapytania do API na przebieg
+            if new_matches or DEBUG_TAIL:
+                try:
+                    tail = api_fetch_recent_tail(s_api, league_id, season_year, tail=10, last_page_rows=last_page_rows)
+                    print("[KONTROLA] Ostatnie 10 meczów (FT) w sezonie:")
+                    for m in tail:
+                        tag = "  REMIS" if m.home_goals == m.away_goals else ""
+                        print(f" - {m.date} {m.time}  {m.home} {m.home_goals}–{m.away_goals} {m.away}{tag}")
+                except Exception as e:
+                    print(f"[KONTROLA] Nie udało się pobrać ogona FT: {e}")
 
             # policz serię
             base_streak = 0 if (FORCE_REBUILD or not last_checked_dt) else prev_streak
             streak, last = apply_new_matches_to_streak(base_streak, new_matches)
-            state["last_streak_len"] = min(streak, MAX_REASONABLE_STREAK)
-            save_state(state)
+
+            # nowy stan – trafia do state dopiero po udanej wysyłce (albo przy obcięciu przez guard,
+            # aby nie zapętlać pobierania); ETag okna razem ze znacznikiem, nigdy bez niego
+            new_state: dict = {"last_streak_len": min(streak, MAX_REASONABLE_STREAK), "api_etag": api_etag}
+            if new_matches:
+                new_state["last_checked_dt"] = new_matches[-1].dt
 
             # sanity guard
             if streak > MAX_REASONABLE_STREAK:
                 print(f"[GUARD] Obcięto alert: obliczona seria {streak} > {MAX_REASONABLE_STREAK}. "
                       f"Prawdopodobnie błąd danych/stanu. Ustaw FORCE_REBUILD=1 i uruchom ponownie.")
-                # mimo wszystko zaktualizuj last_checked_dt, aby nie zapętlać pobierania
-                if new_matches:
-                    state["last_checked_dt"] = new_matches[-1]["dt"]
-                state["last_streak_len"] = min(streak, MAX_REASONABLE_STREAK)
-                save_state(state)
+                state.update(new_state)
                 stamp_run(state)
                 print(f"Aktualna (przycięta) seria bez remisów w Ekstraklasie: {min(streak, MAX_REASONABLE_STREAK)}")
                 return
 
-            # update stanu po poprawnym przeliczeniu
-            if new_matches:
-                state["last_checked_dt"] = new_matches[-1]["dt"]
-            state["last_streak_len"] = streak
-            save_state(state)
-
             print(f"Aktualna seria bez remisów w Ekstraklasie: {streak}")
 
             # wysyłka (zgodnie z ALERT_MODE)
             should_notify = False
             if last and streak >= THRESHOLD:
                 if ALERT_MODE == "EACH":
-                    should_notify = (last.get("dt") != last_notified_dt)
+                    should_notify = (last.dt != last_notified_dt)
                 elif ALERT_MODE == "THRESHOLD_ONLY":
                     should_notify = (prev_streak < THRESHOLD)  # pierwszy raz przebiliśmy
                 else:
-                    should_notify = (last.get("dt") != last_notified_dt)
+                    should_notify = (last.dt != last_notified_dt)
 
             if should_notify and last:
                 text = (
                     f"🔥 <b>Ekstraklasa</b>: seria <b>{streak}</b> meczów z rzędu bez remisu!\n"
-                    f"Ostatni: <b>{last['home']}</b> {last['home_goals']}–{last['away_goals']} "
-                    f"<b>{last['away']}</b> ({last['date']} {last['time']}).\n"
+                    f"Ostatni: <b>{last.home}</b> {last.home_goals}–{last.away_goals} "
+                    f"<b>{last.away}</b> ({last.date} {last.time}).\n"
                     f"Próg: ≥ {THRESHOLD}. Tryb: {ALERT_MODE}.\n"
                     f"Źródło: API-FOOTBALL/v3 (league={league_id}, season={season_year})"
                 )
-                send_telegram(text)
-                state["last_notified_dt"] = last["dt"]
-                save_state(state)
+                if not try_send_telegram(text):
+                    return
+                state["last_notified_dt"] = last.dt
 
+            state.update(new_state)
             stamp_run(state)
             return
         except Exception as e:
@@ -426,28 +805,42 @@ def main() -> None:
     # 3) Fallback (WYŁ. domyślnie)
     if USE_SCRAPE_FALLBACK:
         try:
-            matches, src = fetch_all_matches_via_scrape_incremental(last_checked_dt)
-            streak, last = apply_new_matches_to_streak(0 if (FORCE_REBUILD or not last_checked_dt) else prev_streak, matches)
-            if matches:
-                state["last_checked_dt"] = matches[-1]["dt"]
-            state["last_streak_len"] = streak
-            save_state(state)
+            matches, src = fetch_all_matches_via_scrape_incremental(
+                last_checked_dt, state.setdefault("http_cache", {}), state.get("last_good_url"))
+            state["last_good_url"] = src
+            # źródło zwraca cały sezon: gdy wszystkie mecze mają daty, liczymy tylko te po
+            # last_checked_dt (lista posortowana → bisect); bez dat (parser tekstu) przeliczamy od zera
+            dated = bool(matches) and matches[0].dt != UNDATED_DT
+            if dated and last_checked_dt and not FORCE_REBUILD:
+                new_matches = matches[bisect_right(matches, last_checked_dt, key=attrgetter("dt")):]
+                streak, last = apply_new_matches_to_streak(prev_streak, new_matches)
+            else:
+                streak, last = apply_new_matches_to_streak(0, matches)
+            # znacznik tylko do przodu: strona starsza niż okno API nie może cofnąć last_checked_dt
+            # (API policzyłoby te mecze drugi raz); źródło bez dat nie zna znacznika, więc jego
+            # seria (z całego sezonu) nie nadpisuje last_streak_len liczonego od last_checked_dt
+            new_state = {}
+            if dated:
+                new_state = {"last_streak_len": streak,
+                             "last_checked_dt": max(last_checked_dt or "", matches[-1].dt)}
             print(f"[INFO] Fallback source: {src}")
             print(f"Aktualna seria bez remisów w Ekstraklasie: {streak}")
             # guard
             if streak > MAX_REASONABLE_STREAK:
                 print(f"[GUARD] (fallback) Obcięto alert: {streak} > {MAX_REASONABLE_STREAK}.")
+                state.update(new_state)
                 stamp_run(state)
                 return
             # powiadom
-            if matches and streak >= THRESHOLD and (not last_notified_dt or matches[-1]["dt"] != last_notified_dt):
+            if last and streak >= THRESHOLD and (not last_notified_dt or last.dt != last_notified_dt):
                 text = (
                     f"🔥 <b>Ekstraklasa</b>: seria <b>{streak}</b> meczów z rzędu bez remisu!\n"
                     f"(Źródło fallback: {src})"
                 )
-                send_telegram(text)
-                state["last_notified_dt"] = matches[-1]["dt"]
-                save_state(state)
+                if not try_send_telegram(text):
+                    return
+                state["last_notified_dt"] = last.dt
+            state.update(new_state)
             stamp_run(state)
         except Exception as e:
             print(f"[ERROR] Fallback scrape też nie zadziałał: {e}")
@@ -455,5 +848,12 @@ def main() -> None:
         print("[INFO] Scrape fallback wyłączony (USE_SCRAPE_FALLBACK=0).")
         # nie stemplujemy 'last_full_run_ts', żeby kolejny start mógł spróbować API
 
+def main() -> None:
+    state = load_state()
+    try:
+        run(state)
+    finally:
+        save_state(state)  # jeden zapis na przebieg (pomijany, gdy stan się nie zmienił)
+
 if __name__ == "__main__":
     main()